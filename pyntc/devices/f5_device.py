@@ -2,12 +2,17 @@
 """
 
 import hashlib
+import mmap
 import os
-import re
+import random
 import time
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import bigsuds
 import requests
+from requests.adapters import HTTPAdapter
 from f5.bigip import ManagementRoot
 
 from pyntc.errors import NotEnoughFreeSpaceError, OSInstallError, \
@@ -16,6 +21,17 @@ from .base_device import BaseDevice
 from .system_features.file_copy.base_file_copy import FileTransferError
 
 
+# Checksum algorithms used to verify image transfers, in order of preference.
+# Each entry maps a name to the remote command and the matching local hash constructor.
+# sha256 comes first since OpenSSL uses the SHA extensions of the device and local CPUs where available.
+_HASH_ALGORITHMS = OrderedDict()
+_HASH_ALGORITHMS["sha256"] = ("sha256sum", hashlib.sha256)
+_HASH_ALGORITHMS["md5"] = ("md5sum", hashlib.md5)
+
+# Number of local image scans kept by F5Device, oldest entries are evicted first.
+_LOCAL_IMAGE_CACHE_SIZE = 4
+
+
 class F5Device(BaseDevice):
     def __init__(self, host, username, password, **kwargs):
         super(F5Device, self).__init__(host, username, password, vendor="f5", device_type="f5_tmos_icontrol")
@@ -24,9 +40,57 @@ class F5Device(BaseDevice):
         self.hostname = host
         self.username = username
         self.password = password
-        self.api_handler = ManagementRoot(self.hostname, self.username, self.password)
+        # Token authentication lets the device authenticate once per session instead of on every REST call.
+        self.token = kwargs.get("token", False)
+        self.api_handler = ManagementRoot(self.hostname, self.username, self.password, token=self.token)
+        self._hash_algorithm = None
+        self._local_image_cache = OrderedDict()
+        self._session = None
+        self._open_session()
         self._open_soap()
 
+    @staticmethod
+    def _backoff(delay, max_delay=30, jitter=0.2):
+        """Sleeps for delay seconds plus a random jitter of up to jitter * delay
+
+        Jitter keeps several clients polling the same device from retrying in lockstep.
+
+        Returns:
+            float - the next delay, doubled and capped at max_delay
+        """
+        time.sleep(delay + random.uniform(0, delay * jitter))
+
+        return min(delay * 2, max_delay)
+
+    def _cache_local_image(self, key, size, checksum):
+        """Stores size and checksum of a local image, evicting the oldest entries
+
+        Args:
+            key (tuple): The key as returned by _local_image_key.
+            size (int): The size of the image in bytes.
+            checksum (str): The checksum of the image.
+        """
+        self._local_image_cache[key] = (size, checksum)
+
+        while len(self._local_image_cache) > _LOCAL_IMAGE_CACHE_SIZE:
+            self._local_image_cache.popitem(last=False)
+
+    @staticmethod
+    def _check_chunk_uploaded(result, content_range):
+        """Waits for an image chunk upload to finish and checks the response
+
+        Args:
+            result (AsyncResult): The pending upload request.
+            content_range (str): The Content-Range sent with the chunk.
+
+        Raises:
+            FileTransferError: When the device rejects the chunk.
+        """
+        try:
+            result.get().raise_for_status()
+        except requests.exceptions.HTTPError as err:
+            raise FileTransferError(message="Upload of bytes {} failed: {}".format(content_range, err))
+
     def _check_free_space(self, min_space=0):
         """Checks for minimum space on the device
 
@@ -45,15 +109,15 @@ class F5Device(BaseDevice):
         elif free_space < min_space:
             raise NotEnoughFreeSpaceError(hostname=self.facts.get("hostname"), min_space=min_space)
 
-    def _check_md5sum(self, filename, checksum):
-        """Checks if md5sum is correct
+    def _check_hash(self, filename, checksum, algorithm="md5"):
+        """Checks if the checksum of the file on the device is correct
 
         Returns:
             bool - True / False if checksums match
         """
-        md5sum = self._file_copy_remote_md5(filename)
+        remote_checksum = self._file_copy_remote_hash(filename, algorithm=algorithm)
 
-        if checksum == md5sum:
+        if checksum == remote_checksum:
             return True
         else:
             return False
@@ -62,24 +126,18 @@ class F5Device(BaseDevice):
     def _file_copy_local_file_exists(filepath):
         return os.path.isfile(filepath)
 
-    def _file_copy_local_md5(self, filepath, blocksize=2 ** 20):
-        """Gets md5 checksum from the filepath
+    def _file_copy_local_hash(self, filepath, algorithm="md5"):
+        """Gets checksum from the filepath using the requested algorithm
 
         Returns:
             str - if the file exists
             None - if the file does not exist
         """
         if self._file_copy_local_file_exists(filepath):
-            m = hashlib.md5()
-            with open(filepath, "rb") as f:
-                buf = f.read(blocksize)
-                while buf:
-                    m.update(buf)
-                    buf = f.read(blocksize)
-            return m.hexdigest()
+            return self._scan_local_image(filepath, algorithm=algorithm)[1]
 
-    def _file_copy_remote_md5(self, filepath):
-        """Gets md5 checksum of the filename
+    def _file_copy_remote_hash(self, filepath, algorithm="md5"):
+        """Gets checksum of the filename using the requested algorithm
 
         Example of 'md5sum' command:
 
@@ -87,15 +145,16 @@ class F5Device(BaseDevice):
         c813ac405cab73591492db326ad8893a  /tmp/systemauth.pl
 
         Returns:
-            str - md5sum of the filename
+            str - checksum of the filename
         """
-        md5sum_result = None
-        md5sum_output = self.api_handler.tm.util.bash.exec_cmd("run", utilCmdArgs='-c "md5sum {}"'.format(filepath))
-        if md5sum_output:
-            md5sum_result = md5sum_output.commandResult
-            md5sum_result = md5sum_result.split()[0]
+        command = _HASH_ALGORITHMS[algorithm][0]
+        hash_result = None
+        hash_output = self.api_handler.tm.util.bash.exec_cmd("run", utilCmdArgs='-c "{} {}"'.format(command, filepath))
+        if hasattr(hash_output, "commandResult"):
+            hash_result = hash_output.commandResult
+            hash_result = hash_result.split()[0]
 
-        return md5sum_result
+        return hash_result
 
     def _get_active_volume(self):
         """Gets name of active volume on the device
@@ -123,18 +182,49 @@ class F5Device(BaseDevice):
         free_space = None
         free_space_output = self.api_handler.tm.util.bash.exec_cmd("run", utilCmdArgs='-c "vgdisplay -s --units G"')
         if free_space_output:
-            free_space = free_space_output.commandResult
-            free_space_regex = ".*\s\/\s(\d+\.?\d+) GB free"
-            match = re.match(free_space_regex, free_space)
-
-            if match:
-                free_space = float(match.group(1))
+            # The free space is the first field after the last '/', e.g. "7.10 GB free]".
+            try:
+                free_space = float(free_space_output.commandResult.rsplit("/", 1)[1].split()[0])
+            except (AttributeError, IndexError, ValueError):
+                free_space = None
 
         return free_space
 
+    def _get_hash_algorithm(self):
+        """Gets the preferred checksum algorithm supported by the device
+
+        Commands are probed in order of preference, md5 is the last-resort default.
+
+        Returns:
+            str - name of the checksum algorithm
+        """
+        if self._hash_algorithm is None:
+            for name, (command, _) in _HASH_ALGORITHMS.items():
+                which_cmd = '-c "command -v {}"'.format(command)
+                which_output = self.api_handler.tm.util.bash.exec_cmd("run", utilCmdArgs=which_cmd)
+                if hasattr(which_output, "commandResult") and which_output.commandResult.strip():
+                    self._hash_algorithm = name
+                    break
+            else:
+                self._hash_algorithm = "md5"
+
+        return self._hash_algorithm
+
     def _get_hostname(self):
         return self.soap_handler.Management.Device.get_hostname(self.devices)[0]
 
+    def _get_image(self, image_name):
+        """Gets the image on the device matching image_name
+
+        Returns:
+            image object - if the image exists
+            None - if the image does not exist
+        """
+        # fullPath = u'BIGIP-11.6.0.0.0.401.iso'
+        images_on_device = {_image.fullPath: _image for _image in self._get_images()}
+
+        return images_on_device.get(image_name)
+
     def _get_images(self):
         """Gets list of images on the device
 
@@ -170,6 +260,17 @@ class F5Device(BaseDevice):
 
         return rd_vlan_list
 
+    def _get_token_auth(self):
+        """Gets the token authentication handler of the REST API session
+
+        f5-sdk does not expose its requests session publicly, so this is the only place
+        that depends on its internal structure.
+
+        Returns:
+            iControlRESTTokenAuth - adds X-F5-Auth-Token to requests and renews it when it expires
+        """
+        return self.api_handler._meta_data["icr_session"].session.auth
+
     def _get_volumes(self):
         """Gets list of volumes on the device
 
@@ -196,17 +297,9 @@ class F5Device(BaseDevice):
         Returns:
             bool - True / False if image exists
         """
-        all_images_output = self.api_handler.tm.util.unix_ls.exec_cmd("run", utilCmdArgs="/shared/images")
+        image = self._get_image(image_name)
 
-        if all_images_output:
-            all_images = all_images_output.commandResult.splitlines()
-        else:
-            return None
-
-        if image_name in all_images:
-            return True
-        else:
-            return False
+        return image is not None
 
     def _image_install(self, image_name, volume):
         """Requests the installation of the image on a volume
@@ -223,18 +316,64 @@ class F5Device(BaseDevice):
 
         self.api_handler.tm.sys.software.images.exec_cmd("install", name=image_name, volume=volume, options=options)
 
-    def _image_match(self, image_name, checksum):
-        """Checks if image name matches the checksum
+    @staticmethod
+    def _local_image_key(filepath, algorithm):
+        """Builds the _local_image_cache key of a local image
+
+        Returns:
+            tuple - the (filepath, mtime, size, algorithm) key and the size of the image in bytes
+        """
+        stat = os.stat(filepath)
+
+        return (filepath, stat.st_mtime, stat.st_size, algorithm), stat.st_size
+
+    @staticmethod
+    def _new_hash(algorithm):
+        """Creates a hash object for the named checksum algorithm
 
         Returns:
-            bool - True / False if image matches the checksum
+            hash object - as returned by hashlib
         """
-        if self._image_exists(image_name):
-            image = os.path.join("/shared/images", image_name)
-            if self._check_md5sum(image, checksum):
-                return True
+        constructor = _HASH_ALGORITHMS[algorithm][1]
 
-        return False
+        return constructor()
+
+    def _is_volume_active(self, volume_name):
+        """Checks if volume is the active volume on the device
+
+        Loads only the requested volume rather than the whole volumes collection.
+        A volume that does not exist is reported as not active.
+
+        Returns:
+            bool - True / False if volume is active
+        """
+        try:
+            volume = self.api_handler.tm.sys.software.volumes.volume.load(name=volume_name)
+        except requests.exceptions.HTTPError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return False
+            raise
+
+        return hasattr(volume, "active") and volume.active is True
+
+    def _open_session(self):
+        """Opens a persistent HTTP session used for image uploads
+
+        Reusing the session keeps the connection alive across upload chunks instead of
+        negotiating TLS for every chunk. With token authentication the session shares
+        the X-F5-Auth-Token of the REST API handler, otherwise every chunk carries basic auth.
+        """
+        if self._session is not None:
+            self._session.close()
+
+        self._session = requests.Session()
+        if self.token:
+            self._session.auth = self._get_token_auth()
+        else:
+            self._session.auth = (self.username, self.password)
+        self._session.verify = False
+        self._session.headers.update({"Content-Type": "application/octet-stream"})
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
     def _open_soap(self):
         try:
@@ -260,40 +399,93 @@ class F5Device(BaseDevice):
         """ Reconnects to the device
 
         """
-        self.api_handler = ManagementRoot(self.hostname, self.username, self.password)
+        self.api_handler = ManagementRoot(self.hostname, self.username, self.password, token=self.token)
+        self._open_session()
 
-    def _upload_image(self, image_filepath):
+    def _upload_image(self, image_filepath, size=None, hash_obj=None, chunk_size=4 * 1024 * 1024):
         """Uploads an iso image to the device
 
+        The image is memory-mapped and the next chunk is sliced from the mapping while
+        the previous one is still being posted, so the upload is bound by the slower of
+        the disk and the network.
+
+        Args:
+            image_filepath (str): The path to the local image.
+            size (int): The size of the image in bytes, read from the file when not given.
+            hash_obj (hash object): Optional hashlib object updated with each chunk as it is sent.
+            chunk_size (int): The number of bytes sent per request.
+
         Returns:
             None
+
+        Raises:
+            FileTransferError: When the device rejects a chunk.
         """
         image_filename = os.path.basename(image_filepath)
         _URI = "https://{hostname}/mgmt/cm/autodeploy/software-image-uploads/{filename}".format(
             hostname=self.hostname, filename=image_filename
         )
-        chunk_size = 512 * 1024
-        size = os.path.getsize(image_filepath)
-        headers = {"Content-Type": "application/octet-stream"}
+        if size is None:
+            size = os.path.getsize(image_filepath)
+        # Reused for every chunk; only Content-Range changes between requests.
+        headers = {"Content-Range": ""}
         requests.packages.urllib3.disable_warnings()
-        start = 0
 
-        with open(image_filepath, "rb") as fileobj:
-            while True:
-                payload = fileobj.read(chunk_size)
-                if not payload:
-                    break
+        # An empty file cannot be memory-mapped and has nothing to upload.
+        if not size:
+            return
 
-                end = fileobj.tell()
-                if end < chunk_size:
-                    end = size
-                content_range = "{}-{}/{}".format(start, end - 1, size)
-                headers["Content-Range"] = content_range
-                resp = requests.post(
-                    _URI, auth=(self.username, self.password), data=payload, headers=headers, verify=False
-                )
+        pending = None
+        pool = ThreadPool(processes=1)
+
+        try:
+            with open(image_filepath, "rb") as fileobj:
+                image = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for start in range(0, size, chunk_size):
+                        end = min(start + chunk_size, size)
+                        payload = image[start:end]
+
+                        if hash_obj is not None:
+                            hash_obj.update(payload)
+
+                        # Chunks must arrive in order, so wait for the previous one before sending the next.
+                        if pending is not None:
+                            self._check_chunk_uploaded(*pending)
+
+                        headers["Content-Range"] = "%d-%d/%d" % (start, end - 1, size)
+                        result = pool.apply_async(self._session.post, (_URI,), {"data": payload, "headers": headers})
+                        pending = (result, headers["Content-Range"])
+
+                    self._check_chunk_uploaded(*pending)
+                finally:
+                    image.close()
+        finally:
+            pool.close()
+            pool.join()
+
+    def _scan_local_image(self, filepath, algorithm="md5", blocksize=2 ** 20):
+        """Gets size and checksum of a local image in a single pass
+
+        Results are cached by path, modification time and size, so an unchanged
+        image is not read again while it stays in the cache.
 
-                start += len(payload)
+        Returns:
+            tuple - (size, checksum) of the image
+        """
+        key, _ = self._local_image_key(filepath, algorithm)
+
+        if key not in self._local_image_cache:
+            m = self._new_hash(algorithm)
+            size = 0
+            # Unbuffered reads avoid double-buffering large chunks through the io layer.
+            with open(filepath, "rb", buffering=0) as f:
+                for chunk in iter(partial(f.read, blocksize), b""):
+                    m.update(chunk)
+                    size += len(chunk)
+            self._cache_local_image(key, size, m.hexdigest())
+
+        return self._local_image_cache[key]
 
     @staticmethod
     def _uptime_to_string(uptime):
@@ -317,24 +509,74 @@ class F5Device(BaseDevice):
 
         return result
 
-    def _wait_for_device_reboot(self, volume_name, timeout=600):
+    def _volume_matches(self, volume_name, image):
+        """Checks if volume has completed installation of the image
+
+        Args:
+            volume_name (str): The name of the volume.
+            image (image object): The image as returned by _get_image.
+
+        Returns:
+            bool - True / False if the volume runs the image's version and build
+        """
+        volumes = self._get_volumes()
+
+        return next(
+            (
+                True
+                for _volume in volumes
+                if _volume.name == volume_name
+                and _volume.version == image.version
+                and _volume.basebuild == image.build
+                and _volume.status == "complete"
+            ),
+            False,
+        )
+
+    def _wait_for_device_reboot(self, volume_name, timeout=600, max_auth_failures=3):
         """Waits for the device to be booted into a specified volume
 
+        The delay between attempts doubles with every consecutive failure, capped at 30 seconds.
+        Once the device answers, it is polled every 5 seconds until the volume is active.
+
+        Args:
+            volume_name (str): The volume that the device should be booting into.
+            timeout (int): The number of seconds to wait for device to boot up.
+            max_auth_failures (int): The number of consecutive 401 / 403 responses tolerated.
+
         Returns:
             bool - True / False if reboot has been successful
+
+        Raises:
+            requests.exceptions.HTTPError: When the device keeps rejecting the credentials.
         """
         end_time = time.time() + timeout
         time.sleep(60)
+        errors = 0
+        auth_failures = 0
 
         while time.time() < end_time:
-            time.sleep(5)
+            self._backoff(min(5 * 2 ** errors, 30), jitter=0.1)
             try:
                 self._reconnect()
-                volume = self.api_handler.tm.sys.software.volumes.volume.load(name=volume_name)
-                if hasattr(volume, "active") and volume.active is True:
+                if self._is_volume_active(volume_name):
                     return True
-            except Exception:
-                pass
+                errors = 0
+                auth_failures = 0
+            except requests.exceptions.HTTPError as err:
+                errors += 1
+                # A booting device may briefly reject credentials before its auth services are up,
+                # so only fail once the rejection persists.
+                if err.response is not None and err.response.status_code in (401, 403):
+                    auth_failures += 1
+                    if auth_failures >= max_auth_failures:
+                        raise
+                else:
+                    auth_failures = 0
+            except requests.exceptions.RequestException:
+                # The device refuses connections while it is still booting.
+                errors += 1
+                auth_failures = 0
         return False
 
     def _wait_for_image_installed(self, image_name, volume, timeout=1800):
@@ -349,13 +591,19 @@ class F5Device(BaseDevice):
             OSInstallError: When the volume is not booted before the timeout is reached.
         """
         end_time = time.time() + timeout
+        delay = 2
+        # The image record does not change during installation, so it is only
+        # fetched until found and each poll afterwards only checks the volumes.
+        image = None
 
         while time.time() < end_time:
-            time.sleep(20)
+            delay = self._backoff(delay)
             # Avoid race-conditions issues. Newly created volumes _might_ lack
             # of .version attribute in first seconds of their live.
             try:
-                if self.image_installed(image_name=image_name, volume=volume):
+                if image is None:
+                    image = self._get_image(image_name)
+                if image and self._volume_matches(volume, image):
                     return
             except:
                 pass
@@ -369,7 +617,9 @@ class F5Device(BaseDevice):
         raise NotImplementedError
 
     def close(self):
-        pass
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     def config(self, command):
         raise NotImplementedError
@@ -398,21 +648,36 @@ class F5Device(BaseDevice):
     def file_copy(self, src, dest=None, **kwargs):
         if not self.file_copy_remote_exists(src, dest, **kwargs):
             self._check_free_space(min_space=6)
-            self._upload_image(image_filepath=src)
-            if not self.file_copy_remote_exists(src, dest, **kwargs):
+            # Hash the image while it is uploaded to avoid reading it again for verification.
+            algorithm = self._get_hash_algorithm()
+            key, size = self._local_image_key(src, algorithm)
+            local_hash = self._new_hash(algorithm)
+            self._upload_image(image_filepath=src, size=size, hash_obj=local_hash)
+            remote_image = os.path.join("/shared/images", os.path.basename(src))
+            if not self._check_hash(remote_image, local_hash.hexdigest(), algorithm=algorithm):
                 raise FileTransferError(
                     message="Attempted file copy, but could not validate file existed after transfer"
                 )
+            self._cache_local_image(key, size, local_hash.hexdigest())
 
     # TODO: Make this an internal method since exposing file_copy should be sufficient
     def file_copy_remote_exists(self, src, dest=None, **kwargs):
         if dest and not dest.startswith("/shared/images"):
             raise NotImplementedError("Support only for images - destination is always /shared/images")
 
-        local_md5sum = self._file_copy_local_md5(filepath=src)
         file_basename = os.path.basename(src)
 
-        if not self._image_match(image_name=file_basename, checksum=local_md5sum):
+        # Only read the local image when there is a remote image to compare it with.
+        # The device registers files in /shared/images asynchronously, so a file that is
+        # not registered yet is reported as missing and will be uploaded again.
+        if self._get_image(file_basename) is None:
+            return False
+
+        algorithm = self._get_hash_algorithm()
+        local_checksum = self._file_copy_local_hash(filepath=src, algorithm=algorithm)
+        remote_image = os.path.join("/shared/images", file_basename)
+
+        if not self._check_hash(remote_image, local_checksum, algorithm=algorithm):
             return False
         else:
             return True
@@ -431,25 +696,10 @@ class F5Device(BaseDevice):
         if not image_name or not volume:
             raise RuntimeError("image_name and volume must be specified")
 
-        image = None
-        images_on_device = self._get_images()
-
-        for _image in images_on_device:
-            # fullPath = u'BIGIP-11.6.0.0.0.401.iso'
-            if _image.fullPath == image_name:
-                image = _image
+        image = self._get_image(image_name)
 
         if image:
-            volumes = self._get_volumes()
-
-            for _volume in volumes:
-                if (
-                    _volume.name == volume
-                    and _volume.version == image.version
-                    and _volume.basebuild == image.build
-                    and _volume.status == "complete"
-                ):
-                    return True
+            return self._volume_matches(volume, image)
 
         return False
 
@@ -474,7 +724,7 @@ class F5Device(BaseDevice):
 
     def reboot(self, timer=0, confirm=False, volume=None):
         if confirm:
-            if self._get_active_volume() == volume:
+            if volume is None or self._is_volume_active(volume):
                 volume_name = None
             else:
                 volume_name = volume
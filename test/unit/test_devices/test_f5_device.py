@@ -0,0 +1,261 @@
+import unittest
+import mock
+import hashlib
+import os
+import shutil
+import tempfile
+
+import requests
+
+from pyntc.devices.f5_device import F5Device, FileTransferError
+
+
+def http_error(status_code):
+    return requests.exceptions.HTTPError(response=mock.Mock(status_code=status_code))
+
+
+class TestF5Device(unittest.TestCase):
+
+    @mock.patch('pyntc.devices.f5_device.bigsuds.BIGIP')
+    @mock.patch('pyntc.devices.f5_device.requests.Session')
+    @mock.patch('pyntc.devices.f5_device.ManagementRoot')
+    def setUp(self, mock_mgmt, mock_session, mock_bigip):
+        self.device = F5Device('host', 'user', 'pass')
+        self.api_handler = mock_mgmt.return_value
+        self.session = mock_session.return_value
+        self.responses = []
+        self.content_ranges = []
+        self.session.post.side_effect = self._post
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_image(self, size):
+        path = os.path.join(self.tmpdir, 'BIGIP-13.1.0.iso')
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def _post(self, uri, data, headers):
+        # The headers dict is reused between chunks, so record its value at call time.
+        self.content_ranges.append(headers['Content-Range'])
+        if self.responses:
+            return self.responses.pop(0)
+        return mock.Mock()
+
+    def test_upload_image_content_range(self):
+        image = self._make_image(10)
+
+        self.device._upload_image(image, chunk_size=4)
+
+        self.assertEqual(self.content_ranges, ['0-3/10', '4-7/10', '8-9/10'])
+        uri = self.session.post.call_args[0][0]
+        self.assertEqual(uri, 'https://host/mgmt/cm/autodeploy/software-image-uploads/BIGIP-13.1.0.iso')
+
+    def test_upload_image_failed_chunk(self):
+        image = self._make_image(10)
+        bad_response = mock.Mock()
+        bad_response.raise_for_status.side_effect = http_error(500)
+        self.responses = [mock.Mock(), bad_response, mock.Mock()]
+
+        with self.assertRaisesRegexp(FileTransferError, '4-7/10'):
+            self.device._upload_image(image, chunk_size=4)
+
+        self.assertEqual(self.content_ranges, ['0-3/10', '4-7/10'])
+
+    def test_scan_local_image_cached(self):
+        image = self._make_image(10)
+
+        with mock.patch('pyntc.devices.f5_device.open', wraps=open, create=True) as mock_file:
+            first = self.device._scan_local_image(image, algorithm='md5')
+            second = self.device._scan_local_image(image, algorithm='md5')
+
+        self.assertEqual(first, (10, hashlib.md5(b'x' * 10).hexdigest()))
+        self.assertEqual(second, first)
+        self.assertEqual(mock_file.call_count, 1)
+
+    def test_file_copy_local_hash(self):
+        image = self._make_image(10)
+
+        result = self.device._file_copy_local_hash(image, algorithm='sha256')
+
+        self.assertEqual(result, hashlib.sha256(b'x' * 10).hexdigest())
+        self.assertIsNone(self.device._file_copy_local_hash(os.path.join(self.tmpdir, 'missing.iso')))
+
+    def test_file_copy_remote_exists(self):
+        image = self._make_image(10)
+        self.device._hash_algorithm = 'md5'
+        self.api_handler.tm.util.bash.exec_cmd.return_value.commandResult = (
+            '{}  /shared/images/BIGIP-13.1.0.iso'.format(hashlib.md5(b'x' * 10).hexdigest())
+        )
+
+        with mock.patch.object(F5Device, '_get_image', return_value=mock.Mock()):
+            self.assertTrue(self.device.file_copy_remote_exists(image))
+
+        self.api_handler.tm.util.bash.exec_cmd.assert_called_with(
+            'run', utilCmdArgs='-c "md5sum /shared/images/BIGIP-13.1.0.iso"'
+        )
+
+    def test_file_copy_remote_exists_missing_image(self):
+        image = self._make_image(10)
+
+        with mock.patch.object(F5Device, '_get_image', return_value=None):
+            with mock.patch.object(F5Device, '_scan_local_image') as mock_scan:
+                self.assertFalse(self.device.file_copy_remote_exists(image))
+
+        mock_scan.assert_not_called()
+
+    @mock.patch.object(F5Device, '_check_free_space')
+    @mock.patch.object(F5Device, '_get_image', return_value=None)
+    def test_file_copy(self, mock_get_image, mock_free_space):
+        image = self._make_image(10)
+        checksum = hashlib.md5(b'x' * 10).hexdigest()
+        self.device._hash_algorithm = 'md5'
+        self.api_handler.tm.util.bash.exec_cmd.return_value.commandResult = (
+            '{}  /shared/images/BIGIP-13.1.0.iso'.format(checksum)
+        )
+
+        self.device.file_copy(image)
+
+        self.assertEqual(self.content_ranges, ['0-9/10'])
+        self.assertEqual(self.device._scan_local_image(image, algorithm='md5'), (10, checksum))
+
+    def test_upload_image_hashes_payload(self):
+        image = self._make_image(10)
+        hash_obj = mock.Mock()
+
+        self.device._upload_image(image, hash_obj=hash_obj, chunk_size=4)
+
+        hash_obj.update.assert_has_calls([mock.call(b'xxxx'), mock.call(b'xxxx'), mock.call(b'xx')])
+
+    def test_upload_image_empty_file(self):
+        image = self._make_image(0)
+
+        self.assertIsNone(self.device._upload_image(image, chunk_size=4))
+        self.session.post.assert_not_called()
+
+    def test_is_volume_active_missing_volume(self):
+        self.api_handler.tm.sys.software.volumes.volume.load.side_effect = http_error(404)
+
+        self.assertFalse(self.device._is_volume_active('HD1.9'))
+
+    def test_get_hash_algorithm(self):
+        self.api_handler.tm.util.bash.exec_cmd.return_value = mock.Mock(commandResult='/usr/bin/sha256sum\n')
+
+        self.assertEqual(self.device._get_hash_algorithm(), 'sha256')
+
+    def test_get_hash_algorithm_fallback(self):
+        self.api_handler.tm.util.bash.exec_cmd.side_effect = [
+            mock.Mock(spec=[]),
+            mock.Mock(commandResult='/usr/bin/md5sum\n'),
+        ]
+
+        self.assertEqual(self.device._get_hash_algorithm(), 'md5')
+        self.api_handler.tm.util.bash.exec_cmd.assert_any_call('run', utilCmdArgs='-c "command -v sha256sum"')
+
+    def test_get_free_space(self):
+        self.api_handler.tm.util.bash.exec_cmd.return_value.commandResult = (
+            '"vg-db-sda" 30.98 GB  [23.89 GB  used / 7.10 GB free]'
+        )
+
+        self.assertEqual(self.device._get_free_space(), 7.10)
+
+    def test_get_free_space_integer(self):
+        self.api_handler.tm.util.bash.exec_cmd.return_value.commandResult = (
+            '"vg-db-sda" 30 GB  [23 GB  used / 7 GB free]'
+        )
+
+        self.assertEqual(self.device._get_free_space(), 7.0)
+
+    def test_get_free_space_unparsable(self):
+        self.api_handler.tm.util.bash.exec_cmd.return_value.commandResult = 'No volume groups found'
+
+        self.assertIsNone(self.device._get_free_space())
+
+    @mock.patch('pyntc.devices.f5_device.random.uniform', return_value=0)
+    @mock.patch('pyntc.devices.f5_device.time.sleep')
+    @mock.patch.object(F5Device, '_is_volume_active', return_value=True)
+    @mock.patch.object(F5Device, '_reconnect')
+    def test_wait_for_device_reboot_retries_connection_errors(self, mock_reconnect, mock_active, mock_sleep, mock_rand):
+        connection_error = requests.exceptions.ConnectionError()
+        mock_reconnect.side_effect = [connection_error, connection_error, None]
+
+        self.assertTrue(self.device._wait_for_device_reboot('HD1.2'))
+        self.assertEqual(mock_reconnect.call_count, 3)
+        mock_sleep.assert_has_calls([mock.call(60), mock.call(5), mock.call(10), mock.call(20)])
+
+    @mock.patch('pyntc.devices.f5_device.time.sleep')
+    @mock.patch.object(F5Device, '_is_volume_active', return_value=True)
+    @mock.patch.object(F5Device, '_reconnect')
+    def test_wait_for_device_reboot_transient_auth_failure(self, mock_reconnect, mock_active, mock_sleep):
+        mock_reconnect.side_effect = [http_error(401), None]
+
+        self.assertTrue(self.device._wait_for_device_reboot('HD1.2'))
+
+    @mock.patch('pyntc.devices.f5_device.time.sleep')
+    @mock.patch.object(F5Device, '_reconnect')
+    def test_wait_for_device_reboot_auth_failure(self, mock_reconnect, mock_sleep):
+        mock_reconnect.side_effect = http_error(401)
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.device._wait_for_device_reboot('HD1.2')
+
+        self.assertEqual(mock_reconnect.call_count, 3)
+
+    @mock.patch('pyntc.devices.f5_device.time.sleep')
+    @mock.patch.object(F5Device, '_reconnect')
+    def test_wait_for_device_reboot_unexpected_error(self, mock_reconnect, mock_sleep):
+        mock_reconnect.side_effect = AttributeError('api_handler')
+
+        with self.assertRaises(AttributeError):
+            self.device._wait_for_device_reboot('HD1.2')
+
+    @mock.patch('pyntc.devices.f5_device.bigsuds.BIGIP')
+    @mock.patch('pyntc.devices.f5_device.requests.Session')
+    @mock.patch('pyntc.devices.f5_device.ManagementRoot')
+    def test_open_session_token_auth(self, mock_mgmt, mock_session, mock_bigip):
+        token_auth = mock.Mock()
+        mock_mgmt.return_value._meta_data = {'icr_session': mock.Mock(session=mock.Mock(auth=token_auth))}
+
+        device = F5Device('host', 'user', 'pass', token=True)
+
+        self.assertIs(device._session.auth, token_auth)
+
+    def test_open_session_basic_auth(self):
+        self.assertEqual(self.session.auth, ('user', 'pass'))
+
+    @mock.patch('pyntc.devices.f5_device.requests.Session')
+    @mock.patch('pyntc.devices.f5_device.ManagementRoot')
+    def test_reconnect_closes_session(self, mock_mgmt, mock_session):
+        self.device._reconnect()
+
+        self.session.close.assert_called_once_with()
+        self.assertIs(self.device._session, mock_session.return_value)
+
+    def test_close(self):
+        self.device.close()
+
+        self.session.close.assert_called_once_with()
+        self.assertIsNone(self.device._session)
+
+    @mock.patch('pyntc.devices.f5_device.bigsuds.BIGIP')
+    @mock.patch('pyntc.devices.f5_device.requests.Session')
+    @mock.patch('pyntc.devices.f5_device.ManagementRoot')
+    def test_token_passed_to_management_root(self, mock_mgmt, mock_session, mock_bigip):
+        device = F5Device('host', 'user', 'pass', token=True)
+        mock_mgmt.assert_called_once_with('host', 'user', 'pass', token=True)
+
+        device._reconnect()
+        mock_mgmt.assert_called_with('host', 'user', 'pass', token=True)
+        self.assertEqual(mock_mgmt.call_count, 2)
+
+    @mock.patch('pyntc.devices.f5_device.ManagementRoot')
+    def test_token_defaults_to_false(self, mock_mgmt):
+        self.device._reconnect()
+
+        mock_mgmt.assert_called_once_with('host', 'user', 'pass', token=False)
+
+
+if __name__ == '__main__':
+    unittest.main()